@@ -0,0 +1,130 @@
+"""
+Listed below are IO managers used by the NHTSA assets found in nhtsa_assets.py
+"""
+from dagster import Field, InputContext, IOManager, OutputContext, StringSource, io_manager
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import time
+
+
+# DuckDB only lets one process at a time hold a database file, and dagster's default multiprocess executor (as well as
+# backfills of partitioned assets) runs assets in parallel processes.  Connecting is therefore retried with exponential
+# backoff (0.1s, 0.2s, 0.4s, ...) while another process holds the lock, same as dagster-duckdb's own IO manager does.
+CONNECT_MAX_RETRIES = 10
+CONNECT_INITIAL_DELAY = 0.1
+
+
+class DuckDBArrowIOManager(IOManager):
+    """
+    Stores pandas dataframes as DuckDB tables by handing DuckDB an Arrow table instead of the pandas dataframe.
+
+    The assets build Arrow-backed dataframes, so converting them to an Arrow table is zero-copy and DuckDB can ingest
+    the Arrow buffers directly.  This avoids the extra full copy of the data that goes through DuckDB's pandas scanner.
+    """
+
+    def __init__(self, database: str, schema: str):
+        self._database = database
+        self._schema = schema
+
+    def handle_output(self, context: OutputContext, obj: pd.DataFrame):
+        arrow_table = pa.Table.from_pandas(obj, preserve_index=False)
+
+        con = self._connect()
+        try:
+            schema, table = self._qualified_names(con, context)
+            con.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+            con.register('arrow_table', arrow_table)
+            if context.has_asset_partitions:
+                # Only replace the rows belonging to the partition being materialized.  This is done in one transaction
+                # so that the partition's existing rows are kept if the INSERT fails.
+                con.begin()
+                try:
+                    con.execute(f"CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM arrow_table WHERE 1 = 0")
+                    con.execute(f"DELETE FROM {table} WHERE {self._partition_where(context)}")
+                    con.execute(f"INSERT INTO {table} SELECT * FROM arrow_table")
+                    con.commit()
+                except Exception:
+                    con.rollback()
+                    raise
+            else:
+                con.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM arrow_table")
+            con.unregister('arrow_table')
+        finally:
+            con.close()
+
+        context.log.info(f"Wrote {arrow_table.num_rows} rows to {table}")
+
+    def load_input(self, context: InputContext) -> pd.DataFrame:
+        # Same "columns" metadata used by the assets to select specific columns from an upstream asset
+        columns = ', '.join((context.metadata or {}).get('columns', ['*']))
+
+        con = self._connect(read_only=True)
+        try:
+            _, table = self._qualified_names(con, context)
+            arrow_table = con.execute(f"SELECT {columns} FROM {table}").fetch_arrow_table()
+        finally:
+            con.close()
+
+        df = arrow_table.to_pandas(types_mapper=pd.ArrowDtype)
+        # Lower-case the column names the same way the Snowflake IO manager does, since the downstream assets select
+        # columns by their lower-case names (e.g. "mfr_id")
+        df.columns = df.columns.str.lower()
+
+        return df
+
+    def _qualified_names(self, con: duckdb.DuckDBPyConnection, context) -> tuple:
+        """
+        Return the fully qualified (catalog.schema, catalog.schema.table) names for the asset.
+
+        DuckDB names the catalog after the database file, so e.g. a nhtsa.duckdb file with a "nhtsa" schema would make
+        a plain nhtsa.table reference ambiguous.
+        """
+
+        catalog = con.execute("SELECT current_database()").fetchone()[0]
+        schema = f'"{catalog}"."{self._schema}"'
+
+        return schema, f'{schema}."{context.asset_key.path[-1]}"'
+
+    def _connect(self, read_only: bool = False) -> duckdb.DuckDBPyConnection:
+        """
+        Connect to the DuckDB database file, waiting for other processes to release their lock on it.
+        """
+
+        for attempt in range(CONNECT_MAX_RETRIES + 1):
+            try:
+                return duckdb.connect(self._database, read_only=read_only)
+            except (duckdb.IOException, RuntimeError):
+                if attempt == CONNECT_MAX_RETRIES:
+                    raise
+                time.sleep(CONNECT_INITIAL_DELAY * 2 ** attempt)
+
+    @staticmethod
+    def _partition_where(context: OutputContext) -> str:
+        """
+        Build the WHERE clause that selects the rows of the partition being materialized, using the partition_expr
+        metadata of the asset: a column name, or a dict of {dimension: column name} for multi-partitioned assets.
+        """
+
+        partition_expr = context.metadata['partition_expr']
+        partition_key = context.asset_partition_key
+        if isinstance(partition_expr, dict):
+            return ' AND '.join(
+                f"{partition_expr[dimension]} = '{key}'"
+                for dimension, key in partition_key.keys_by_dimension.items()
+            )
+
+        return f"{partition_expr} = '{partition_key}'"
+
+
+@io_manager(
+    config_schema={
+        "database": Field(StringSource, description="Path to the DuckDB database file"),
+        "schema": Field(str, default_value="nhtsa", is_required=False),
+    }
+)
+def duckdb_arrow_io_manager(init_context) -> DuckDBArrowIOManager:
+    return DuckDBArrowIOManager(
+        database=init_context.resource_config["database"],
+        schema=init_context.resource_config["schema"],
+    )
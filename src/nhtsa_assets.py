@@ -1,10 +1,17 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dagster_snowflake_pandas import snowflake_pandas_io_manager
-from dagster import AssetIn, Definitions, SourceAsset, asset
-from tqdm import tqdm
-from utilities import fetch_manufacturers, fetch_model_names, fetch_wmi_by_manufacturer, fetch_wmi_data
-import io
+from dagster import (AssetIn, Definitions, Field, MultiPartitionsDefinition, SourceAsset, StaticPartitionsDefinition,
+                     asset)
+from io_managers import duckdb_arrow_io_manager
+from tqdm.contrib.concurrent import thread_map
+from utilities import (combine_chunks, constant_column, fetch_makes, fetch_manufacturers, fetch_model_names,
+                       fetch_wmi_by_manufacturer, fetch_wmi_data, fetch_wmi_data_concurrently, read_csv_bytes)
+import numpy as np
+import os
 import pandas as pd
+import pyarrow as pa
 import requests
 
 
@@ -15,6 +22,35 @@ import requests
 make_id_cars_trucks_motorcycles = SourceAsset(key='make_id_cars_trucks_motorcycles')
 make_id_cars_trucks_motorcycles.description = 'Table containing make IDs for cars, trucks, and motorcycles only'
 
+# Fetching from NHTSA's API is I/O bound (nearly all the time is spent waiting on the server), so the assets that make
+# thousands of requests issue them concurrently from a pool of threads
+MAX_WORKERS = 32
+
+# Number of manufacturer pages to request ahead of the page currently being processed
+PAGE_WINDOW = 8
+
+# Stand-in for manufacturers whose VehicleTypes list is empty (see manufacturers() below)
+EMPTY_VEHICLE_TYPES = [{'IsPrimary': None, 'Name': None}]
+
+# Arrow schema of the flattened manufacturer rows.  Every page is built with the same schema so that the per-page tables
+# can be concatenated, even when a column happens to be entirely null on one of the pages.
+MANUFACTURERS_SCHEMA = pa.schema([
+    ('IsPrimary', pa.bool_()),
+    ('Name', pa.string()),
+    ('Country', pa.string()),
+    ('Mfr_CommonName', pa.string()),
+    ('Mfr_ID', pa.int64()),
+    ('Mfr_Name', pa.string()),
+])
+
+# Explicit column types for the model name CSVs returned by NHTSA, so that nothing is left to type inference
+MODEL_NAMES_COLUMN_TYPES = {
+    'make_id': pa.int32(),
+    'make_name': pa.string(),
+    'model_id': pa.int32(),
+    'model_name': pa.string(),
+}
+
 
 @asset(group_name="nhtsa")
 def manufacturers(context) -> pd.DataFrame:
@@ -22,40 +58,53 @@ def manufacturers(context) -> pd.DataFrame:
     Vehicle manufacturer information from NHTSA API
     """
 
-    df_list = []
+    tables = []
     page = 1
-    while True:
-        context.log.info(f"Fetching page {page}")
-        json_dict = fetch_manufacturers(page)     # imported from utilities
-        if json_dict['Count'] == 0:
-            context.log.info("Count is equal to zero/0 - exiting loop")
-            break
-        else:
-            # json_normalize() will drop records where the record_path contains an empty list
-            # To prevent this, see this SO question:
-            # https://stackoverflow.com/questions/63813378/how-to-json-normalize-a-column-in-pandas-with-empty-lists-without-losing-record
-            # For loop below is checking for "emptiness" of VehicleTypes, if empty,then fill with dictionary
-            for i, record in enumerate(json_dict['Results']):
-                if not record['VehicleTypes']:
-                    json_dict['Results'][i]['VehicleTypes'] = [{'IsPrimary': 'Null', 'Name': 'Null'}]
-
-            context.log.info(f"    Count={json_dict['Count']}")
-
-            df = pd.json_normalize(
-                json_dict['Results'],
-                record_path=['VehicleTypes'],
-                meta=['Country', 'Mfr_CommonName', 'Mfr_ID', 'Mfr_Name'],
-            )
-            df_list.append(df)
-            page = page + 1
-
-    df_combined = pd.concat(df_list, ignore_index=True)
+    with ThreadPoolExecutor(max_workers=PAGE_WINDOW) as executor:
+        # Keep the next PAGE_WINDOW pages in flight so that page k+1 is already being fetched while page k is processed
+        pending = deque(executor.submit(fetch_manufacturers, p) for p in range(page, page + PAGE_WINDOW))
+        while True:
+            context.log.info(f"Fetching page {page}")
+            json_dict = pending.popleft().result()     # fetch_manufacturers() imported from utilities
+            if json_dict['Count'] == 0:
+                context.log.info("Count is equal to zero/0 - exiting loop")
+                for future in pending:
+                    future.cancel()
+                break
+            else:
+                pending.append(executor.submit(fetch_manufacturers, page + PAGE_WINDOW))
+
+                context.log.info(f"    Count={json_dict['Count']}")
+
+                # Flatten each manufacturer into one row per vehicle type.  Manufacturers with an empty VehicleTypes
+                # list get a single row from the sentinel list so that they are not dropped.
+                # Background on why the records would otherwise go missing (when using pd.json_normalize()):
+                # https://stackoverflow.com/questions/63813378/how-to-json-normalize-a-column-in-pandas-with-empty-lists-without-losing-record
+                rows = [
+                    {
+                        'IsPrimary': vehicle_type['IsPrimary'],
+                        'Name': vehicle_type['Name'],
+                        'Country': record['Country'],
+                        'Mfr_CommonName': record['Mfr_CommonName'],
+                        'Mfr_ID': record['Mfr_ID'],
+                        'Mfr_Name': record['Mfr_Name'],
+                    }
+                    for record in json_dict['Results']
+                    for vehicle_type in (record['VehicleTypes'] or EMPTY_VEHICLE_TYPES)
+                ]
+                # Pages are accumulated as Arrow tables and only converted to a pandas dataframe once, after the loop
+                tables.append(pa.Table.from_pylist(rows, schema=MANUFACTURERS_SCHEMA))
+                page = page + 1
+
+    df_combined = combine_chunks(pa.concat_tables(tables).to_pandas(types_mapper=pd.ArrowDtype))
+    context.log.info(f"Number of rows in manufacturers dataframe: {df_combined.shape[0]}")
 
+    # De-duplicate before adding Created_Date and only on the columns we keep.  Created_Date is the same on every row, so
+    # hashing it would only cost time and memory without changing which rows are duplicates.
+    df_combined = df_combined[['Mfr_ID', 'Mfr_Name', 'Mfr_CommonName', 'Country']].drop_duplicates()
     today = datetime.today().strftime('%Y-%m-%d')
-    df_combined = df_combined.assign(Created_Date=today)
-    context.log.info(f"Number of rows in manufacturers dataframe: {df_combined.shape[0]}")
 
-    return df_combined[['Mfr_ID', 'Mfr_Name', 'Mfr_CommonName', 'Country', 'Created_Date']].drop_duplicates()
+    return df_combined.assign(Created_Date=constant_column(today, len(df_combined)))
 
 
 @asset(group_name="nhtsa")
@@ -64,17 +113,38 @@ def makes() -> pd.DataFrame:
     Vehicle makes from NHTSA API
     """
 
-    df = pd.read_csv('https://vpic.nhtsa.dot.gov/api/vehicles/GetAllMakes?format=csv')
+    df = fetch_makes()      # imported from utilities
     today = datetime.today().strftime('%Y-%m-%d')
-    df = df.assign(created_date=today)
+    df = df.assign(created_date=constant_column(today, len(df)))
 
     return df
 
 
+# model_names is partitioned by model year and vehicle type: historic model years rarely change, so a scheduled run only
+# needs to re-materialize the current model year's partitions instead of re-fetching every year.
+# The first model year is fixed (rather than "the last 15 years") because rows of a year that drops out of the partitions
+# definition would never be replaced or removed from the table.  A new model year's partitions are added automatically
+# on January 1.  See the readme for how to move MODEL_NAMES_FIRST_YEAR forward.
+# https://docs.dagster.io/concepts/partitions-schedules-sensors/partitions
+MODEL_NAMES_FIRST_YEAR = 2012
+current_year = datetime.today().year
+model_names_partitions = MultiPartitionsDefinition(
+    {
+        "year": StaticPartitionsDefinition([str(year) for year in range(MODEL_NAMES_FIRST_YEAR, current_year + 1)]),
+        "vehicle_type": StaticPartitionsDefinition(['passenger', 'truck', 'motorcycle']),
+    }
+)
+
+
 # To return only make_id column, need to add this extra boilerplate
 # https://docs.dagster.io/integrations/snowflake/reference#selecting-specific-columns-in-a-downstream-asset
+# partition_expr tells the IO manager which columns hold the partition values, so that materializing a partition only
+# replaces that partition's rows in the table
+# https://docs.dagster.io/integrations/snowflake/reference
 @asset(
     group_name="nhtsa",
+    partitions_def=model_names_partitions,
+    metadata={"partition_expr": {"year": "year", "vehicle_type": "vehicle_type"}},
     ins={
         "make_id_cars_trucks_motorcycles": AssetIn(
             key="make_id_cars_trucks_motorcycles",
@@ -82,9 +152,11 @@ def makes() -> pd.DataFrame:
         )
     }
 )
-def model_names(make_id_cars_trucks_motorcycles: pd.DataFrame) -> pd.DataFrame:
+def model_names(context, make_id_cars_trucks_motorcycles: pd.DataFrame) -> pd.DataFrame:
     """
-    Vehicle model names from NHTSA API (passenger cars and trucks only, last 15 years)
+    Vehicle model names from NHTSA API (passenger cars, trucks and motorcycles, model years MODEL_NAMES_FIRST_YEAR and
+    later).
+    Each partition holds a single model year and vehicle type.
 
     Parameters
     ----------
@@ -98,39 +170,39 @@ def model_names(make_id_cars_trucks_motorcycles: pd.DataFrame) -> pd.DataFrame:
 
     # A good source for vehicle makes: https://cars.usnews.com/cars-trucks/car-brands-available-in-america
 
-    # Instead of hard-coding that we want last 15 model years, we can programmatically define the years for us
-    current_year = datetime.today().year
-    start_year = datetime.today().year - 14
-
-    df_list = []
-
-    # Initialize progress bar
-    progress_bar = tqdm(total=(current_year - start_year + 1) * len(make_id_cars_trucks_motorcycles) * 3)
-
-    for year in range(start_year, current_year + 1):
-        for make_id in make_id_cars_trucks_motorcycles['make_id']:
-            for vehicle_type in ['passenger', 'truck', 'motorcycle']:
-                try:
-                    response = fetch_model_names(make_id=make_id, model_year=year, vehicle_type=vehicle_type)
-                    response.raise_for_status()
-                except requests.exceptions.HTTPError as e:
-                    print(f"HTTP error occurred: {e}")
-                    continue
-                csv_file = io.StringIO(response.content.decode('utf-8'))
-                df = pd.read_csv(csv_file)
-                df = df.assign(year=year)
-                # Some model_names can "look" like int types and so we want to make sure they are explicitly defined as str
-                # when concatenating the dataframes together.  Otherwise, will get a pyarrow error due to int/str confusion.
-                # Relevant background: https://github.com/wesm/feather/issues/349
-                df['model_name'] = df['model_name'].astype('str')
-                df_list.append(df)
-                progress_bar.update(1)  # increment progress bar
-
-    df_concat = pd.concat(df_list, ignore_index=True)
+    partition = context.partition_key.keys_by_dimension
+    year = int(partition['year'])
+    vehicle_type = partition['vehicle_type']
+    context.log.info(f"Fetching model names for model year {year}, vehicle type {vehicle_type}")
+
+    def fetch(make_id: int) -> pd.DataFrame:
+        try:
+            response = fetch_model_names(make_id=make_id, model_year=year, vehicle_type=vehicle_type)
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            print(f"HTTP error occurred: {e}")
+            return None
+        # Some model_names can "look" like int types and so we want to make sure they are explicitly read as strings.
+        # Otherwise, will get a pyarrow error due to int/str confusion when concatenating the dataframes together.
+        # Relevant background: https://github.com/wesm/feather/issues/349
+        df = read_csv_bytes(response.content, column_types=MODEL_NAMES_COLUMN_TYPES)     # imported from utilities
+        return df
+
+    # thread_map() runs fetch() on a pool of threads and advances a tqdm progress bar as results come back
+    results = thread_map(fetch, make_id_cars_trucks_motorcycles['make_id'], max_workers=MAX_WORKERS)
+    df_list = [df for df in results if df is not None]
+
+    # De-duplicate before adding the (constant) Created_Date column so that it is not part of the row hash
+    df_concat = combine_chunks(pd.concat(df_list, copy=False, ignore_index=True)).drop_duplicates()
     today = datetime.today().strftime('%Y-%m-%d')
-    df_concat = df_concat.assign(Created_Date=today)
 
-    return df_concat.drop_duplicates()
+    # year and vehicle_type are the same for every row of a partition, so they are added once to the combined dataframe
+    # instead of to each of the per-make dataframes
+    return df_concat.assign(
+        year=np.full(len(df_concat), year, dtype='int16'),
+        vehicle_type=constant_column(vehicle_type, len(df_concat)),
+        Created_Date=constant_column(today, len(df_concat)),
+    )
 
 
 # To return only mfr_id column, need to add this extra boilerplate
@@ -150,17 +222,15 @@ def wmi_by_manufacturer_id(manufacturers: pd.DataFrame) -> pd.DataFrame:
     It will take up to approximately 2 hours to materialize this asset.
     """
 
-    df_list = []
-    for mfr_id in tqdm(manufacturers['mfr_id']):
-        df = fetch_wmi_by_manufacturer(mfr_id)      # imported from utilities
-        if df is not None:
-            df_list.append(df)
+    # fetch_wmi_by_manufacturer() imported from utilities
+    results = thread_map(fetch_wmi_by_manufacturer, manufacturers['mfr_id'], max_workers=MAX_WORKERS)
+    df_list = [df for df in results if df is not None]
 
-    df_concat = pd.concat(df_list, ignore_index=True)
+    # De-duplicate before adding the (constant) Created_Date column so that it is not part of the row hash
+    df_concat = combine_chunks(pd.concat(df_list, copy=False, ignore_index=True)).drop_duplicates()
     today = datetime.today().strftime('%Y-%m-%d')
-    df_concat = df_concat.assign(Created_Date=today)
 
-    return df_concat.drop_duplicates()
+    return df_concat.assign(Created_Date=constant_column(today, len(df_concat)))
 
 
 # To return only wmi column, need to add this extra boilerplate
@@ -172,9 +242,17 @@ def wmi_by_manufacturer_id(manufacturers: pd.DataFrame) -> pd.DataFrame:
             key="wmi_by_manufacturer_id",
             metadata={"columns": ["wmi"]},
         )
-    }
+    },
+    config_schema={
+        "use_async": Field(
+            bool,
+            default_value=False,
+            is_required=False,
+            description="Fetch the WMI data with asyncio + httpx (HTTP/2) instead of a pool of threads",
+        )
+    },
 )
-def wmi_with_makes(wmi_by_manufacturer_id: pd.DataFrame) -> pd.DataFrame:
+def wmi_with_makes(context, wmi_by_manufacturer_id: pd.DataFrame) -> pd.DataFrame:
     """
     WMI codes with vehicle make information from NHTSA's API.
 
@@ -187,18 +265,38 @@ def wmi_with_makes(wmi_by_manufacturer_id: pd.DataFrame) -> pd.DataFrame:
     pandas dataframe
     """
 
-    df_list = []
-    for wmi in tqdm(wmi_by_manufacturer_id['wmi']):
-        df = fetch_wmi_data(wmi)          # imported from utilities
-        if df is not None:
-            df_list.append(df)
+    # fetch_wmi_data() and fetch_wmi_data_concurrently() imported from utilities
+    if context.op_config["use_async"]:
+        context.log.info("Fetching WMI data using asyncio")
+        results = fetch_wmi_data_concurrently(wmi_by_manufacturer_id['wmi'])
+    else:
+        results = thread_map(fetch_wmi_data, wmi_by_manufacturer_id['wmi'], max_workers=MAX_WORKERS)
+    df_list = [df for df in results if df is not None]
 
-    df_concat = pd.concat(df_list, ignore_index=True)
+    # De-duplicate before adding the (constant) Created_Date column so that it is not part of the row hash
+    df_concat = pd.concat(df_list, copy=False, ignore_index=True).drop_duplicates()
     today = datetime.today().strftime('%Y-%m-%d')
-    df_concat = df_concat.assign(Created_Date=today)
-
-    return df_concat.drop_duplicates()
 
+    return df_concat.assign(Created_Date=constant_column(today, len(df_concat)))
+
+
+# Set DUCKDB_DATABASE (e.g. in your .env file) to the path of a DuckDB database file to store the assets there instead
+# of in Snowflake
+if os.getenv('DUCKDB_DATABASE'):
+    io_manager = duckdb_arrow_io_manager.configured({"database": {"env": "DUCKDB_DATABASE"}, "schema": "nhtsa"})
+else:
+    io_manager = snowflake_pandas_io_manager.configured(
+        {
+            "account": {"env": "SF_ACCOUNT"},
+            "warehouse": {"env": "SF_WAREHOUSE"},
+            "database": {"env": "SF_DATABASE"},
+            "schema": "nhtsa",
+            "role": {"env": "SF_ROLE"},
+            "user": {"env": "SF_USERNAME"},
+            "password": {"env": "SF_PASSWORD"},
+            "authenticator": {"env": "SF_AUTHENTICATOR"},
+        }
+    )
 
 defs = Definitions(
     assets=[
@@ -209,19 +307,5 @@ defs = Definitions(
         wmi_by_manufacturer_id,
         wmi_with_makes,
     ],
-    resources={
-        "io_manager": snowflake_pandas_io_manager.configured(
-            {
-                "account": {"env": "SF_ACCOUNT"},
-                "warehouse": {"env": "SF_WAREHOUSE"},
-                "database": {"env": "SF_DATABASE"},
-                "schema": "nhtsa",
-                "role": {"env": "SF_ROLE"},
-                "user": {"env": "SF_USERNAME"},
-                "password": {"env": "SF_PASSWORD"},
-                "authenticator": {"env": "SF_AUTHENTICATOR"},
-            }
-        )
-    },
+    resources={"io_manager": io_manager},
 )
-
@@ -1,10 +1,130 @@
 """
 Listed below are functions used by the NHTSA assets/functions found in nhtsa_assets.py
 """
-import io
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import asyncio
+import httpx
 import json
+import numpy as np
+import orjson
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket that paces calls to at most `rate` per second (allowing short bursts of up to `burst`).
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token from the bucket and return how many seconds the caller has to wait before it may use it.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self._rate)
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+
+class RateLimitedRetry(Retry):
+    """
+    urllib3 Retry policy that also waits for a token from the rate limiter before every retry.
+
+    urllib3 retries inside a single HTTPAdapter.send() call, so without this only the first attempt of a request would
+    be paced and a burst of 429/5xx responses would be retried at full speed.
+    """
+
+    def __init__(self, *args, rate_limiter: RateLimiter = None, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        # urllib3 creates a new Retry object for every attempt, so carry the rate limiter over to it
+        kwargs.setdefault('rate_limiter', self.rate_limiter)
+        return super().new(**kwargs)
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that waits for a token from the rate limiter before sending each request over the network.  Pair it
+    with RateLimitedRetry so that retries of the request wait for a token too.
+    """
+
+    def __init__(self, rate_limiter: RateLimiter, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.rate_limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+# A single session shared by all of the fetch functions below so that connections to vpic.nhtsa.dot.gov are kept alive
+# and re-used across requests (and across threads) instead of paying for a new TCP/TLS handshake on every call.
+# Transient errors and rate limiting (429) are retried with exponential backoff.  raise_on_status=False hands the last
+# response back after the retries are exhausted, so callers still get an HTTPError from raise_for_status().
+# With many threads fetching at once, requests are also paced to NHTSA_MAX_RPS requests per second (default 10) so that
+# NHTSA does not start answering with 429s, which would only slow things down further through retries.  Responses
+# served from the cache below never reach the adapter, so they are not rate limited.
+# Every attempt, including each retry, takes a token from the rate limiter.
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+max_rps = float(os.getenv('NHTSA_MAX_RPS', '10'))
+if not max_rps > 0:
+    raise ValueError(f"NHTSA_MAX_RPS must be greater than 0, got {os.getenv('NHTSA_MAX_RPS')!r}")
+rate_limiter = RateLimiter(rate=max_rps)
+retry = RateLimitedRetry(
+    total=RETRY_TOTAL,
+    backoff_factor=RETRY_BACKOFF_FACTOR,
+    status_forcelist=RETRY_STATUS_CODES,
+    raise_on_status=False,
+    rate_limiter=rate_limiter,
+)
+adapter = RateLimitedAdapter(rate_limiter, max_retries=retry, pool_connections=64, pool_maxsize=64)
+
+# NHTSA's responses rarely change, so successful responses are cached on disk and re-materializing an asset only goes
+# out to the network for responses that are missing or have expired.  The cache is a SQLite file next to this module
+# (src/nhtsa_cache.sqlite) unless NHTSA_CACHE_PATH points somewhere else.
+# https://requests-cache.readthedocs.io/en/stable/user_guide/expiration.html
+cache_path = os.getenv('NHTSA_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nhtsa_cache.sqlite'))
+SESSION = requests_cache.CachedSession(
+    cache_path,
+    backend='sqlite',
+    expire_after=timedelta(days=30),
+    urls_expire_after={
+        'vpic.nhtsa.dot.gov/api/vehicles/getallmanufacturers': timedelta(days=7),
+        'vpic.nhtsa.dot.gov/api/vehicles/GetModelsForMakeIdYear': timedelta(days=7),
+    },
+)
+SESSION.mount('https://', adapter)
 
 
 def fetch_manufacturers(page: int) -> dict:
@@ -15,16 +135,32 @@ def fetch_manufacturers(page: int) -> dict:
     url = f'https://vpic.nhtsa.dot.gov/api/vehicles/getallmanufacturers?ManufacturerType=&format=json&page={str(page)}'
 
     try:
-        response = requests.get(url, timeout=15)
+        response = SESSION.get(url, timeout=15)
         response.raise_for_status()  # raise an error if status code is not ok
     except (requests.exceptions.RequestException, requests.exceptions.SSLError) as e:
         print(f"Error occurred while fetching page {page}: {str(e)}")
 
-    json_dict = json.loads(response.text)
+    json_dict = orjson.loads(response.content)
 
     return json_dict
 
 
+def fetch_makes() -> pd.DataFrame:
+    """
+    Fetch all vehicle makes from NHTSA's vPIC api.
+
+    Returns
+    -------
+    pandas dataframe
+    """
+
+    url = 'https://vpic.nhtsa.dot.gov/api/vehicles/GetAllMakes?format=csv'
+    response = SESSION.get(url, timeout=60)
+    response.raise_for_status()
+
+    return read_csv_bytes(response.content, column_types={'make_id': pa.int32(), 'make_name': pa.string()})
+
+
 def fetch_model_names(make_id: int, model_year: int, vehicle_type: str) -> requests.models.Response:
     """
     Fetch model name information from NHTSA's vPIC api
@@ -40,7 +176,7 @@ def fetch_model_names(make_id: int, model_year: int, vehicle_type: str) -> reque
 
     url = f'https://vpic.nhtsa.dot.gov/api/vehicles/GetModelsForMakeIdYear/makeId/{make_id}/modelyear/{model_year}/vehicletype/{vehicle_type}?format=csv'
     try:
-        response = requests.get(url, timeout=15)
+        response = SESSION.get(url, timeout=15)
         response.raise_for_status()
     except requests.exceptions.HTTPError as e:
         print(f"HTTP error occurred: {e}")
@@ -48,6 +184,21 @@ def fetch_model_names(make_id: int, model_year: int, vehicle_type: str) -> reque
     return response
 
 
+# Explicit column types for the WMI CSVs returned by NHTSA.  Every column is pinned so that nothing is left to type
+# inference: a column that is inferred as numeric for one manufacturer and as text for another cannot be written out
+# once the dataframes are concatenated, and the dates are kept as the strings NHTSA returns.
+WMI_COLUMN_TYPES = {
+    'country': pa.string(),
+    'createdon': pa.string(),
+    'dateavailable': pa.string(),
+    'id': pa.int64(),
+    'name': pa.string(),
+    'updatedon': pa.string(),
+    'vehicletype': pa.string(),
+    'wmi': pa.string(),
+}
+
+
 def fetch_wmi_by_manufacturer(mfr_id: int) -> pd.DataFrame:
     """
     Fetch WMI by manufacturer ID using NHTSA's vPIC api.
@@ -63,21 +214,19 @@ def fetch_wmi_by_manufacturer(mfr_id: int) -> pd.DataFrame:
     """
     url = f'https://vpic.nhtsa.dot.gov/api/vehicles/GetWMIsForManufacturer/{str(mfr_id)}?format=csv'
     try:
-        response = requests.get(url, timeout=15)
+        response = SESSION.get(url, timeout=15)
         response.raise_for_status()
     except requests.exceptions.HTTPError as e:
         print(f"HTTP error occurred: {e}")
         return None
     except requests.exceptions.ReadTimeout:
         print("Read timeout error occurred, retrying with longer timeout...")
-        response = requests.get(url, timeout=60)
+        response = SESSION.get(url, timeout=60)
 
-    csv_file = io.StringIO(response.content.decode('utf-8'))
-    df = pd.read_csv(csv_file)
-    # Some WMI codes can "look" like int types and so we want to make sure they are explicitly defined as str
-    # when concatenating the dataframes together.  Otherwise, will get a pyarrow error due to int/str confusion.
+    # Some WMI codes can "look" like int types and so we want to make sure they are explicitly read as strings.
+    # Otherwise, will get a pyarrow error due to int/str confusion when concatenating the dataframes together.
     # Relevant background: https://github.com/wesm/feather/issues/349
-    df['wmi'] = df['wmi'].astype('str')
+    df = read_csv_bytes(response.content, column_types=WMI_COLUMN_TYPES)
     return df
 
 
@@ -96,20 +245,199 @@ def fetch_wmi_data(wmi) -> pd.DataFrame:
 
     url = f'https://vpic.nhtsa.dot.gov/api/vehicles/decodewmi/{wmi}?format=json'
     try:
-        response = requests.get(url, timeout=15)
+        response = SESSION.get(url, timeout=15)
         response.raise_for_status()  # Raise an exception for 4xx and 5xx HTTP status codes
     except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
         print(f'Error fetching data for WMI {wmi}: {e}')
         return pd.DataFrame()
     except requests.exceptions.ReadTimeout:
         print("Read timeout error occurred, retrying with longer timeout...")
-        res = requests.get(url, timeout=60)
+        res = SESSION.get(url, timeout=60)
+
+    return parse_wmi_data(response.content, wmi)
+
+
+async def fetch_wmi_data_async(client: httpx.AsyncClient, wmi) -> pd.DataFrame:
+    """
+    Async version of fetch_wmi_data() using an httpx client.  Note that these requests do not go through SESSION and
+    therefore are not cached, but they are still paced by the same rate limiter and retried on the same errors and
+    status codes (honouring NHTSA's Retry-After header).
+
+    Parameters
+    ----------
+    client, wmi
+
+    Returns
+    -------
+    pandas dataframe
+    """
+
+    url = f'https://vpic.nhtsa.dot.gov/api/vehicles/decodewmi/{wmi}?format=json'
+    for attempt in range(RETRY_TOTAL + 1):
+        await asyncio.sleep(rate_limiter.reserve())
+        try:
+            response = await client.get(url, timeout=15)
+            if response.status_code in RETRY_STATUS_CODES and attempt < RETRY_TOTAL:
+                await asyncio.sleep(retry_delay(attempt, response.headers.get('Retry-After')))
+                continue
+            response.raise_for_status()  # Raise an exception for 4xx and 5xx HTTP status codes
+            break
+        except httpx.TransportError as e:
+            # Connection errors and timeouts
+            if attempt < RETRY_TOTAL:
+                await asyncio.sleep(retry_delay(attempt))
+                continue
+            print(f'Error fetching data for WMI {wmi}: {e}')
+            return pd.DataFrame()
+        except (httpx.RequestError, httpx.HTTPStatusError) as e:
+            # Any other error (e.g. decoding the response, too many redirects) only drops this WMI, same as
+            # fetch_wmi_data(), instead of aborting every other request gathered with it
+            print(f'Error fetching data for WMI {wmi}: {e}')
+            return pd.DataFrame()
+
+    return parse_wmi_data(response.content, wmi)
+
+
+def retry_delay(attempt: int, retry_after: str = None) -> float:
+    """
+    Number of seconds to wait before retrying a request: the server's Retry-After header when it sent one (either a
+    number of seconds or an HTTP date), otherwise the same exponential backoff the urllib3 Retry policy uses.
+
+    Parameters
+    ----------
+    attempt, retry_after
+
+    Returns
+    -------
+    float
+    """
+
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+
+    return RETRY_BACKOFF_FACTOR * 2 ** attempt
+
+
+def parse_wmi_data(content: bytes, wmi) -> pd.DataFrame:
+    """
+    Parse the JSON bytes of a decodewmi response from NHTSA's vPIC api into a pandas dataframe.
+
+    Parameters
+    ----------
+    content, wmi
+
+    Returns
+    -------
+    pandas dataframe
+    """
 
     try:
-        df = pd.json_normalize(json.loads(response.text), record_path=['Results'])
+        df = pd.json_normalize(orjson.loads(content), record_path=['Results'])
         df = df.assign(WMI=wmi)
     except json.JSONDecodeError as e:
         print(f'Error decoding JSON data for WMI {wmi}: {e}')
         return pd.DataFrame()
 
     return df
+
+
+def fetch_wmi_data_concurrently(wmis, max_connections: int = 64) -> list:
+    """
+    Fetches WMI information for many WMI codes at once on a single thread using asyncio.  Requests are multiplexed over
+    HTTP/2 connections, with at most max_connections requests in flight at a time.
+
+    Parameters
+    ----------
+    wmis, max_connections
+
+    Returns
+    -------
+    list of pandas dataframes, in the same order as wmis
+    """
+
+    async def run() -> list:
+        semaphore = asyncio.Semaphore(max_connections)
+        limits = httpx.Limits(max_connections=max_connections)
+        async with httpx.AsyncClient(http2=True, limits=limits) as client:
+
+            async def bounded_fetch(wmi) -> pd.DataFrame:
+                async with semaphore:
+                    return await fetch_wmi_data_async(client, wmi)
+
+            return await asyncio.gather(*[bounded_fetch(wmi) for wmi in wmis])
+
+    return asyncio.run(run())
+
+
+def read_csv_bytes(content: bytes, column_types: dict = None) -> pd.DataFrame:
+    """
+    Parse the raw bytes of a CSV response from NHTSA's vPIC api into an Arrow-backed pandas dataframe.
+
+    The bytes are handed straight to pyarrow's CSV reader, so there is no decode to str and no copy into a StringIO.
+    Columns listed in column_types are read with the given pyarrow types; the rest are inferred.  Empty values are read
+    as nulls, the same as pd.read_csv() does.
+
+    Parameters
+    ----------
+    content, column_types
+
+    Returns
+    -------
+    pandas dataframe
+    """
+
+    table = pacsv.read_csv(
+        pa.BufferReader(content),
+        convert_options=pacsv.ConvertOptions(column_types=column_types or {}, strings_can_be_null=True),
+    )
+
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def combine_chunks(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Combine the chunks of every Arrow-backed column into a single contiguous array.
+
+    Concatenating N Arrow-backed dataframes leaves each column as a ChunkedArray with N chunks, which makes string
+    operations and writing the dataframe out significantly slower when there are many small chunks.
+
+    Parameters
+    ----------
+    df
+
+    Returns
+    -------
+    pandas dataframe
+    """
+
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.ArrowDtype):
+            df[col] = pd.arrays.ArrowExtensionArray(pa.array(df[col].array).combine_chunks())
+
+    return df
+
+
+def constant_column(value, length: int) -> pd.Categorical:
+    """
+    Build a column that holds the same value on every row (e.g. the Created_Date stamp on each asset).
+
+    The column is a categorical with a single category, so it stores one copy of the value plus a 1-byte code per row
+    instead of one Python object per row.
+
+    Parameters
+    ----------
+    value, length
+
+    Returns
+    -------
+    pandas categorical
+    """
+
+    return pd.Categorical.from_codes(np.zeros(length, dtype='int8'), categories=[value])
@@ -0,0 +1,18 @@
+import os
+import shutil
+import sys
+import tempfile
+
+# The dagster code lives in src/ and is run from there (dagster dev -f nhtsa_assets.py), so make its modules importable
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+def pytest_configure(config):
+    # utilities creates its HTTP response cache on import.  Give every test run a fresh, empty cache outside the repo so
+    # that tests never write into the source tree or get answered from responses cached by earlier runs.
+    config.nhtsa_cache_dir = tempfile.mkdtemp(prefix='nhtsa_cache_')
+    os.environ['NHTSA_CACHE_PATH'] = os.path.join(config.nhtsa_cache_dir, 'nhtsa_cache.sqlite')
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(config.nhtsa_cache_dir, ignore_errors=True)
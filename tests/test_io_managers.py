@@ -0,0 +1,132 @@
+from types import SimpleNamespace
+import logging
+
+from dagster import AssetKey, MultiPartitionKey
+import duckdb
+import pandas as pd
+import pytest
+
+import io_managers
+from io_managers import DuckDBArrowIOManager
+
+
+def output_context(partition_key=None, partition_expr=None):
+    return SimpleNamespace(
+        asset_key=AssetKey('model_names'),
+        has_asset_partitions=partition_key is not None,
+        asset_partition_key=partition_key,
+        metadata={'partition_expr': partition_expr} if partition_expr else {},
+        log=logging.getLogger(__name__),
+    )
+
+
+def input_context(columns=None):
+    return SimpleNamespace(asset_key=AssetKey('model_names'), metadata={'columns': columns} if columns else {})
+
+
+def test_partition_where_single_dimension():
+    context = output_context(partition_key='2020', partition_expr='year')
+
+    assert DuckDBArrowIOManager._partition_where(context) == "year = '2020'"
+
+
+def test_partition_where_multi_dimension():
+    context = output_context(
+        partition_key=MultiPartitionKey({'year': '2020', 'vehicle_type': 'truck'}),
+        partition_expr={'year': 'year', 'vehicle_type': 'vehicle_type'},
+    )
+
+    where = DuckDBArrowIOManager._partition_where(context)
+
+    assert sorted(where.split(' AND ')) == ["vehicle_type = 'truck'", "year = '2020'"]
+
+
+def test_duckdb_io_manager_only_replaces_materialized_partition(tmp_path):
+    manager = DuckDBArrowIOManager(database=str(tmp_path / 'nhtsa.duckdb'), schema='nhtsa')
+    partition_expr = {'year': 'year', 'vehicle_type': 'vehicle_type'}
+
+    def materialize(year, vehicle_type, model_names):
+        df = pd.DataFrame({'model_name': model_names, 'year': year, 'vehicle_type': vehicle_type})
+        key = MultiPartitionKey({'year': str(year), 'vehicle_type': vehicle_type})
+        manager.handle_output(output_context(partition_key=key, partition_expr=partition_expr), df)
+
+    materialize(2020, 'passenger', ['Accord', 'Civic'])
+    materialize(2020, 'truck', ['Ridgeline'])
+    materialize(2021, 'passenger', ['Accord'])
+    # Re-materializing a partition replaces its rows and leaves the other partitions alone
+    materialize(2020, 'passenger', ['Insight'])
+
+    df = manager.load_input(input_context())
+    rows = sorted(zip(df['year'], df['vehicle_type'], df['model_name']))
+
+    assert rows == [
+        (2020, 'passenger', 'Insight'),
+        (2020, 'truck', 'Ridgeline'),
+        (2021, 'passenger', 'Accord'),
+    ]
+
+
+def test_duckdb_io_manager_loads_selected_columns_in_lower_case(tmp_path):
+    manager = DuckDBArrowIOManager(database=str(tmp_path / 'nhtsa.duckdb'), schema='nhtsa')
+    manager.handle_output(output_context(), pd.DataFrame({'Mfr_ID': [1, 2], 'Mfr_Name': ['A', 'B']}))
+
+    df = manager.load_input(input_context(columns=['mfr_id']))
+
+    assert list(df.columns) == ['mfr_id']
+    assert list(df['mfr_id']) == [1, 2]
+
+
+def test_duckdb_io_manager_retries_while_database_is_locked(tmp_path, monkeypatch):
+    manager = DuckDBArrowIOManager(database=str(tmp_path / 'nhtsa.duckdb'), schema='nhtsa')
+    connect = duckdb.connect
+    attempts = []
+
+    def locked_twice(*args, **kwargs):
+        attempts.append(args)
+        if len(attempts) <= 2:
+            raise duckdb.IOException('Could not set lock on file')
+        return connect(*args, **kwargs)
+
+    monkeypatch.setattr(io_managers.duckdb, 'connect', locked_twice)
+    monkeypatch.setattr(io_managers.time, 'sleep', lambda seconds: None)
+
+    manager.handle_output(output_context(), pd.DataFrame({'make_id': [1]}))
+
+    assert len(attempts) == 3
+
+
+def test_duckdb_io_manager_gives_up_after_max_retries(tmp_path, monkeypatch):
+    manager = DuckDBArrowIOManager(database=str(tmp_path / 'nhtsa.duckdb'), schema='nhtsa')
+
+    def always_locked(*args, **kwargs):
+        raise duckdb.IOException('Could not set lock on file')
+
+    monkeypatch.setattr(io_managers.duckdb, 'connect', always_locked)
+    monkeypatch.setattr(io_managers.time, 'sleep', lambda seconds: None)
+
+    with pytest.raises(duckdb.IOException):
+        manager.handle_output(output_context(), pd.DataFrame({'make_id': [1]}))
+
+
+def test_duckdb_io_manager_keeps_partition_rows_when_replacing_them_fails(tmp_path):
+    manager = DuckDBArrowIOManager(database=str(tmp_path / 'nhtsa.duckdb'), schema='nhtsa')
+    partition_expr = {'year': 'year', 'vehicle_type': 'vehicle_type'}
+    context = output_context(
+        partition_key=MultiPartitionKey({'year': '2020', 'vehicle_type': 'truck'}),
+        partition_expr=partition_expr,
+    )
+    manager.handle_output(
+        context,
+        pd.DataFrame({'model_name': ['Ridgeline', 'Tacoma'], 'year': 2020, 'vehicle_type': 'truck'}),
+    )
+
+    # One column too many for the existing table, so the INSERT fails after the DELETE has run
+    with pytest.raises(duckdb.Error):
+        manager.handle_output(
+            context,
+            pd.DataFrame({'model_name': ['Ridgeline'], 'year': 2020, 'vehicle_type': 'truck', 'extra': 1}),
+        )
+
+    df = manager.load_input(input_context())
+
+    assert sorted(df['model_name']) == ['Ridgeline', 'Tacoma']
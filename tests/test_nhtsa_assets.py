@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from dagster import MultiPartitionKey, build_asset_context
+import pandas as pd
+import requests
+
+import nhtsa_assets
+
+
+def manufacturer(mfr_id, vehicle_types):
+    return {
+        'Country': 'UNITED STATES (USA)',
+        'Mfr_CommonName': f'Common {mfr_id}',
+        'Mfr_ID': mfr_id,
+        'Mfr_Name': f'MANUFACTURER {mfr_id}',
+        'VehicleTypes': vehicle_types,
+    }
+
+
+def test_manufacturers_consumes_pages_in_order_and_stops_at_first_empty_page(monkeypatch):
+    pages = {
+        1: [manufacturer(1, [{'IsPrimary': True, 'Name': 'Passenger Car'}, {'IsPrimary': False, 'Name': 'Truck'}])],
+        2: [manufacturer(2, [])],
+        3: [manufacturer(3, [{'IsPrimary': True, 'Name': 'Motorcycle'}])],
+        4: [],
+        # NHTSA would not return anything after the first empty page; this makes sure it would be ignored
+        5: [manufacturer(5, [{'IsPrimary': True, 'Name': 'Bus'}])],
+    }
+    release = threading.Event()
+    requested = []
+
+    def fetch_manufacturers(page):
+        requested.append(page)
+        if page <= 3:
+            # Later pages finish first, so the pages arrive out of order
+            time.sleep(0.1 * (4 - page))
+        elif page > 4:
+            # Keep the workers busy so that the lookahead pages submitted later stay queued until they are cancelled
+            release.wait(timeout=0.5)
+        results = pages.get(page, [])
+        return {'Count': len(results), 'Results': results}
+
+    monkeypatch.setattr(nhtsa_assets, 'fetch_manufacturers', fetch_manufacturers)
+    # Fewer workers than PAGE_WINDOW, so that some of the lookahead pages are queued rather than already running
+    monkeypatch.setattr(nhtsa_assets, 'ThreadPoolExecutor', lambda max_workers: ThreadPoolExecutor(max_workers=4))
+
+    try:
+        df = nhtsa_assets.manufacturers(build_asset_context())
+    finally:
+        release.set()
+
+    assert list(df.columns) == ['Mfr_ID', 'Mfr_Name', 'Mfr_CommonName', 'Country', 'Created_Date']
+    # One row per manufacturer (the two vehicle types of manufacturer 1 de-duplicate), in page order, including the
+    # manufacturer without any vehicle types
+    assert list(df['Mfr_ID']) == [1, 2, 3]
+    assert list(df['Mfr_Name']) == ['MANUFACTURER 1', 'MANUFACTURER 2', 'MANUFACTURER 3']
+    assert str(df['Mfr_ID'].dtype) == 'int64[pyarrow]'
+    assert str(df['Created_Date'].dtype) == 'category'
+    # Pages 1-8 are submitted up front and pages 9-11 as pages 1-3 are consumed.  Pages 9-11 are still queued behind
+    # the busy workers when page 4 comes back empty, so they are cancelled without ever being requested.
+    assert sorted(requested) == list(range(1, nhtsa_assets.PAGE_WINDOW + 1))
+
+
+def csv_response(status_code, content=b''):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.url = 'https://vpic.nhtsa.dot.gov/api/vehicles/GetModelsForMakeIdYear'
+    return response
+
+
+def test_model_names_fetches_the_partition_and_adds_partition_columns(monkeypatch):
+    header = b'make_id,make_name,model_id,model_name\n'
+    csvs = {
+        474: header + b'474,HONDA,1861,Ridgeline\n474,HONDA,1861,Ridgeline\n',
+        448: header + b'448,TOYOTA,2208,1500\n',
+    }
+    calls = []
+
+    def fetch_model_names(make_id, model_year, vehicle_type):
+        calls.append((make_id, model_year, vehicle_type))
+        if make_id not in csvs:
+            return csv_response(404)
+        return csv_response(200, csvs[make_id])
+
+    monkeypatch.setattr(nhtsa_assets, 'fetch_model_names', fetch_model_names)
+    context = build_asset_context(partition_key=MultiPartitionKey({'year': '2020', 'vehicle_type': 'truck'}))
+
+    df = nhtsa_assets.model_names(context, pd.DataFrame({'make_id': [474, 448, 999]}))
+
+    assert sorted(calls) == [(448, 2020, 'truck'), (474, 2020, 'truck'), (999, 2020, 'truck')]
+    assert sorted(df['model_name']) == ['1500', 'Ridgeline']
+    assert list(df.columns) == [
+        'make_id', 'make_name', 'model_id', 'model_name', 'year', 'vehicle_type', 'Created_Date',
+    ]
+    assert df.dtypes.astype(str).to_dict() == {
+        'make_id': 'int32[pyarrow]',
+        'make_name': 'string[pyarrow]',
+        'model_id': 'int32[pyarrow]',
+        'model_name': 'string[pyarrow]',
+        'year': 'int16',
+        'vehicle_type': 'category',
+        'Created_Date': 'category',
+    }
+    # partition_expr of the asset refers to these columns
+    assert set(df['year']) == {2020}
+    assert set(df['vehicle_type']) == {'truck'}
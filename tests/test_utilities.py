@@ -0,0 +1,205 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import asyncio
+import importlib
+import os
+import threading
+import time
+
+import httpx
+import orjson
+import pandas as pd
+import pyarrow as pa
+import pytest
+import requests
+
+import utilities
+
+
+def run_fetch_wmi_data_async(responses, monkeypatch):
+    """
+    Run fetch_wmi_data_async() against a mock transport that answers with the given responses in order, and return the
+    dataframe, the number of requests made and the delays slept for.
+    """
+
+    requests_made = []
+    delays = []
+
+    def handler(request):
+        requests_made.append(request)
+        return responses[len(requests_made) - 1]
+
+    async def sleep(seconds):
+        delays.append(seconds)
+
+    monkeypatch.setattr(utilities.asyncio, 'sleep', sleep)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await utilities.fetch_wmi_data_async(client, '1HG')
+
+    return asyncio.run(run()), len(requests_made), delays
+
+
+def test_fetch_wmi_data_async_retries_and_honours_retry_after(monkeypatch):
+    content = orjson.dumps({'Results': [{'Make': 'HONDA'}]})
+    responses = [
+        httpx.Response(429, headers={'Retry-After': '7'}),
+        httpx.Response(503),
+        httpx.Response(200, content=content),
+    ]
+
+    df, requests_made, delays = run_fetch_wmi_data_async(responses, monkeypatch)
+
+    assert requests_made == 3
+    assert 7 in delays
+    assert df.to_dict('records') == [{'Make': 'HONDA', 'WMI': '1HG'}]
+
+
+def test_fetch_wmi_data_async_gives_up_after_retry_total(monkeypatch):
+    responses = [httpx.Response(503)] * (utilities.RETRY_TOTAL + 1)
+
+    df, requests_made, _ = run_fetch_wmi_data_async(responses, monkeypatch)
+
+    assert requests_made == utilities.RETRY_TOTAL + 1
+    assert df.empty
+
+
+def test_fetch_wmi_data_async_does_not_retry_client_errors(monkeypatch):
+    df, requests_made, _ = run_fetch_wmi_data_async([httpx.Response(404)], monkeypatch)
+
+    assert requests_made == 1
+    assert df.empty
+
+
+def test_fetch_wmi_data_async_gives_up_on_decoding_errors():
+    def handler(request):
+        raise httpx.DecodingError('Error decoding gzip content', request=request)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await utilities.fetch_wmi_data_async(client, '1HG')
+
+    assert asyncio.run(run()).empty
+
+
+def test_fetch_wmi_data_concurrently_keeps_going_after_one_wmi_fails(monkeypatch):
+    def handler(request):
+        wmi = request.url.path.split('/')[-1]
+        if wmi == 'BAD':
+            raise httpx.DecodingError('Error decoding gzip content', request=request)
+        return httpx.Response(200, content=orjson.dumps({'Results': [{'Make': f'MAKE {wmi}'}]}))
+
+    async_client = httpx.AsyncClient
+    monkeypatch.setattr(
+        utilities.httpx,
+        'AsyncClient',
+        lambda **kwargs: async_client(transport=httpx.MockTransport(handler)),
+    )
+
+    results = utilities.fetch_wmi_data_concurrently(['1HG', 'BAD', 'JHM'])
+
+    assert [df.to_dict('records') for df in results] == [
+        [{'Make': 'MAKE 1HG', 'WMI': '1HG'}],
+        [],
+        [{'Make': 'MAKE JHM', 'WMI': 'JHM'}],
+    ]
+
+
+def test_retry_delay():
+    assert utilities.retry_delay(0, '2') == 2
+    assert utilities.retry_delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert utilities.retry_delay(2) == utilities.RETRY_BACKOFF_FACTOR * 4
+    assert utilities.retry_delay(1, 'not a date') == utilities.RETRY_BACKOFF_FACTOR * 2
+
+
+def test_wmi_csvs_concatenate_to_consistent_string_columns():
+    header = b'country,createdon,dateavailable,id,name,updatedon,vehicletype,wmi\n'
+    first = utilities.read_csv_bytes(
+        header + b'UNITED STATES,2015-03-04,2015-03-04,1,HONDA,2016-01-01,Passenger Car,123\n',
+        column_types=utilities.WMI_COLUMN_TYPES,
+    )
+    second = utilities.read_csv_bytes(
+        header + b',,,2,1234,,Truck,1HG\n',
+        column_types=utilities.WMI_COLUMN_TYPES,
+    )
+
+    df = utilities.combine_chunks(pd.concat([first, second], copy=False, ignore_index=True))
+
+    assert all(str(dtype) == 'string[pyarrow]' for column, dtype in df.dtypes.items() if column != 'id')
+    assert df['createdon'][0] == '2015-03-04'
+    assert pd.isna(df['createdon'][1])
+    assert list(df['wmi']) == ['123', '1HG']
+    # Writing the dataframe out (e.g. by the IO manager) must not hit int/str confusion
+    pa.Table.from_pandas(df, preserve_index=False)
+
+
+def test_rate_limiter_paces_concurrent_callers():
+    rate_limiter = utilities.RateLimiter(rate=20)
+    threads = [threading.Thread(target=rate_limiter.acquire) for _ in range(21)]
+
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    # The first call goes through immediately and the other 20 are spaced 1/20th of a second apart
+    assert 0.95 <= elapsed < 1.5
+
+
+def test_rate_limiter_allows_bursts_after_idling():
+    rate_limiter = utilities.RateLimiter(rate=10, burst=3)
+    time.sleep(0.3)
+
+    assert [rate_limiter.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert rate_limiter.reserve() > 0
+
+
+@pytest.mark.parametrize('max_rps', ['0', '-5', 'nan'])
+def test_invalid_max_rps_is_rejected_at_import(monkeypatch, max_rps):
+    monkeypatch.setenv('NHTSA_MAX_RPS', max_rps)
+    with pytest.raises(ValueError, match='NHTSA_MAX_RPS'):
+        importlib.reload(utilities)
+
+    monkeypatch.delenv('NHTSA_MAX_RPS')
+    importlib.reload(utilities)
+
+
+def test_response_cache_uses_nhtsa_cache_path():
+    assert utilities.cache_path == os.environ['NHTSA_CACHE_PATH']
+    assert os.path.exists(utilities.cache_path)
+
+
+def test_every_retry_takes_a_rate_limiter_token(monkeypatch):
+    statuses = [503, 503, 503, 200]
+    requests_served = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_served.append(self.path)
+            self.send_response(statuses[len(requests_served) - 1])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    tokens = []
+    monkeypatch.setattr(utilities.rate_limiter, 'acquire', lambda: tokens.append(1))
+    monkeypatch.setattr(utilities.retry, 'backoff_factor', 0)
+    session = requests.Session()
+    session.mount('http://', utilities.adapter)
+
+    try:
+        response = session.get(f'http://127.0.0.1:{server.server_port}/decodewmi', timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert response.status_code == 200
+    assert len(requests_served) == 4
+    assert len(tokens) == 4